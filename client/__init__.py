@@ -1,2 +1,2 @@
-from .client import AsyncClient, Requestor, RateLimitContext
+from .client import AsyncClient, Requestor, RateLimitContext, BucketedRateLimiter
 from .fn import *
\ No newline at end of file
@@ -3,9 +3,12 @@ This module provides classes for managing HTTP requests and rate limiting.
 """
 from abc import ABC, abstractmethod
 import asyncio
+from collections import OrderedDict
 from copy import deepcopy
+from functools import partial
+import sys
 import time
-from typing import Any, Coroutine, Dict, Generic, List, Optional, TypeVar
+from typing import Any, Callable, Coroutine, Dict, Generic, List, Optional, Tuple, TypeVar, Union
 import httpx
 from corex import logger
 from ..db import DatabaseManager
@@ -15,53 +18,181 @@ RequestorType = TypeVar("RequestorType", bound="Requestor")
 LimiterType = TypeVar("LimiterType", bound="RateLimitContext")
 T = TypeVar("T")
 
+_IMMUTABLE_SCALARS = (type(None), bool, int, float, str, bytes)
+
+
+def _is_immutable(value: Any) -> bool:
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(v) for v in value)
+    return isinstance(value, _IMMUTABLE_SCALARS)
+
+
+def _default_factory_for(value: Any) -> Callable[[], Any]:
+    """Returns a zero-arg factory producing a fresh copy of a legacy default value."""
+    if _is_immutable(value):
+        return lambda: value
+    if type(value) in (list, dict, set) and not value:
+        return type(value)
+    return lambda: deepcopy(value)
+
 
 class RateLimitContext:    
+    MIN_SLEEP = 1e-4  # Waits shorter than this yield with sleep(0) instead of arming a timer
+    _HEADER_KEYS: Tuple[bytes, ...] = (b"x-ratelimit-remaining", b"x-ratelimit-reset", b"retry-after")
+
     def __init__(self, max_calls: int, period: int, max_concurrency: int = 1):
-        self._max_calls = max_calls  # Period in seconds
-        self._rate = max_calls / period  # Tokens added per second
-        self._tokens = max_calls  # Maximum tokens
-        self._last = time.monotonic()
+        self._burst = max_calls  # Calls allowed back to back before spacing kicks in
+        self._interval = period / max_calls  # Seconds per token
+        self._next_free = time.monotonic()  # Time at which every reserved slot has elapsed and the bucket is full again
         self._lock = asyncio.Lock()
-        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._permits: asyncio.Queue = asyncio.Queue(max_concurrency)
+        for _ in range(max_concurrency):
+            self._permits.put_nowait(None)
     
+    def set_used_tokens_nowait(self, used: int):
+        """
+        Sync variant of set_used_tokens for use inside _apply / _adjust_rate_limit_locked.
+        """
+        # Only ever move the deadline forward, so slots reserved locally are kept
+        self._next_free = max(self._next_free, time.monotonic() + used * self._interval)
+
     async def set_used_tokens(self, used: int):
         async with self._lock:
-            self._tokens = self._max_calls - used
+            self.set_used_tokens_nowait(used)
             
-    async def sleep(self, seconds: float):
-        async with self._lock:
-            await asyncio.sleep(seconds)
-
     async def _acquire_token(self, weight: int = 1):
         async with self._lock:
             now = time.monotonic()
-            elapsed = now - self._last
-            self._last = now
-            self._tokens = min(self._tokens + (elapsed * self._rate), self._max_calls)
-            required_tokens = weight
-            if self._tokens < required_tokens:
-                logger.debug(f"Sleeping for {(required_tokens - self._tokens) / self._rate} seconds")
-                await asyncio.sleep((required_tokens - self._tokens) / self._rate)
-                now = time.monotonic()
-                elapsed = now - self._last
-                self._last = now
-                self._tokens = min(self._tokens + (elapsed * self._rate), self._max_calls)
-            self._tokens -= required_tokens
+            self._next_free = max(self._next_free, now) + weight * self._interval
+            wait = self._next_free - now - self._burst * self._interval
+        # Sleep outside the lock, the slot is already reserved
+        if wait <= 0:
+            return
+        try:
+            if wait < self.MIN_SLEEP:
+                # Too short to be worth a timer, just yield to the loop
+                await asyncio.sleep(0)
+                return
+            logger.debug(f"Sleeping for {wait} seconds")
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # Give the unused slot back so later callers don't wait for it
+            self._next_free -= weight * self._interval
+            raise
 
     async def limit_request(self, weight: int = 1):
-        async with self._semaphore:
+        permit = await self._permits.get()
+        try:
             await self._acquire_token(weight)
+        finally:
+            self._permits.put_nowait(permit)
+
+    def observe(self, headers: httpx.Headers):
+        """
+        Applies response headers without taking the lock. This is safe because
+        no critical section in this class awaits while holding the lock, so it
+        can't run in the middle of one.
+        """
+        self._adjust_rate_limit_locked(headers)
 
-    @abstractmethod
     async def adjust_rate_limit(self, headers: httpx.Headers):
         """
         Adjusts the rate limit based on the response headers from an API.
+        Called by AsyncClient._get after every response. Subclasses may still
+        override this; the default applies the headers through observe().
+        """
+        self.observe(headers)
+
+    def _adjust_rate_limit_locked(self, headers: httpx.Headers):
+        """
+        Adjusts the rate limit based on the response headers from an API.
+        Runs synchronously, so implementations must not await. Use
+        set_used_tokens_nowait rather than set_used_tokens.
+        """
+        self._apply(self._scan(headers.raw))
+
+    def _scan(self, raw: List[Tuple[bytes, bytes]]) -> Dict[bytes, bytes]:
+        """
+        Collects the values of _HEADER_KEYS in a single pass over the raw headers.
+        """
+        keys = self._HEADER_KEYS
+        found = {}
+        for key, value in raw:
+            key = key.lower()
+            if key in keys:
+                found[key] = value
+        return found
+
+    def _apply(self, scan: Dict[bytes, bytes]):
+        """
+        Applies the scanned rate limit headers, keyed by lowercased header name.
+        Runs synchronously, so use set_used_tokens_nowait rather than set_used_tokens.
         Subclasses should implement this to handle specific API rate limiting schemes.
         """
         pass
     
 
+class BucketedRateLimiter:
+    """
+    Shards rate limiting into one RateLimitContext per bucket so independent
+    endpoints don't contend on a single lock.
+    """
+    MAX_BUCKETS = 256  # Least recently used buckets beyond this are dropped
+    _BUCKET_KEY = b"x-ratelimit-bucket"
+
+    def __init__(
+        self,
+        factory: Callable[[], RateLimitContext],
+        key_func: Optional[Callable[[str], str]] = None
+    ):
+        """
+        :param factory: Builds the RateLimitContext for a new bucket.
+        :param key_func: Maps an endpoint to its bucket key, e.g. to strip ids from "/orders/123".
+        """
+        self._factory = factory
+        self._key_func = key_func
+        self._buckets: OrderedDict[str, RateLimitContext] = OrderedDict()
+        self._aliases: OrderedDict[str, str] = OrderedDict()  # Endpoint key -> bucket id reported by the API
+
+    def _endpoint_key(self, endpoint: str) -> str:
+        return endpoint if self._key_func is None else self._key_func(endpoint)
+
+    def _key(self, endpoint: str) -> str:
+        key = self._endpoint_key(endpoint)
+        return self._aliases.get(key, key)
+
+    def _bucket(self, key: str) -> RateLimitContext:
+        # No awaits in here, so concurrent callers can't create the same bucket twice
+        ctx = self._buckets.get(key)
+        if ctx is None:
+            ctx = self._buckets[key] = self._factory()
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return ctx
+
+    async def bucket_for(self, endpoint: str) -> RateLimitContext:
+        return self._bucket(self._key(endpoint))
+
+    def rebucket(self, endpoint: str, headers: httpx.Headers, ctx: RateLimitContext) -> RateLimitContext:
+        """
+        Returns the context the response belongs to, following a bucket id
+        reported by the API. Returns ctx unchanged when there is none.
+        """
+        for name, value in headers.raw:
+            if name.lower() == self._BUCKET_KEY:
+                bucket = value.decode("latin-1")
+                key = self._endpoint_key(endpoint)
+                if self._aliases.get(key) != bucket:
+                    self._aliases[key] = bucket
+                    if len(self._aliases) > self.MAX_BUCKETS:
+                        self._aliases.popitem(last=False)
+                    return self._bucket(bucket)
+                break
+        return ctx
+
+
 class AsyncClient(ABC):
     def __init__(
         self,
@@ -70,16 +201,22 @@ class AsyncClient(ABC):
         follow_redirects: bool = True,
         http2: bool = True,
         timeout: int = 30,
-        rate_limit_context: LimiterType = None
+        rate_limit_context: Union[LimiterType, BucketedRateLimiter] = None,
+        max_connections: Optional[int] = 100,
+        max_keepalive: Optional[int] = 20,
+        keepalive_expiry: float = 30.0
     ):
-        if base_url.endswith("/"):
-            base_url = base_url[:-1]
-        self.base_url = base_url
+        self.base_url = base_url.rstrip("/")
         self._headers = headers
+        # Keep idle connections around longer than httpx's 5s default to avoid repeated handshakes
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_keepalive,
+                              keepalive_expiry=keepalive_expiry)
         self._session = httpx.AsyncClient(headers=self._headers,
                                           follow_redirects=follow_redirects,
                                           http2=http2,
-                                          timeout=timeout)
+                                          timeout=timeout,
+                                          limits=limits)
         self._rate_limit_context = rate_limit_context
 
     async def __aenter__(self):
@@ -89,6 +226,11 @@ class AsyncClient(ABC):
     async def __aexit__(self, exc_type, exc, tb):
         await self._session.__aexit__(exc_type, exc, tb)
         
+    async def _bucket_for(self, endpoint: str) -> RateLimitContext:
+        if isinstance(self._rate_limit_context, BucketedRateLimiter):
+            return await self._rate_limit_context.bucket_for(endpoint)
+        return self._rate_limit_context
+
     async def _post_signed(self, signed_request: str, data: Any = None, **kwargs: Any) -> httpx.Response:
         response = await self._session.post(signed_request, data=data, **kwargs)
         return await self._handle(response)
@@ -98,52 +240,50 @@ class AsyncClient(ABC):
         return await self._handle(response)
     
     @abstractmethod
-    async def get(self, endpoint: str, params: Optional[dict] = None):
+    async def get(self, endpoint: str, params: Optional[dict] = None, weight: int = 1):
         """
         """
         raise NotImplementedError("All subclasses must implement the get method")
 
-    async def _get(self, endpoint: str, params: Optional[str] = None, **kwargs) -> httpx.Response:
-        url = f"{self.base_url}{endpoint}"
-        if params:
-            url += f"?{params}"
-
-        response = await self._session.get(url, **kwargs)
-        await self._rate_limit_context.adjust_rate_limit(response.headers)
-        await self._rate_limit_context.limit_request()
+    async def _get(self, endpoint: str, params: Optional[Union[dict, str]] = None, weight: int = 1, **kwargs) -> httpx.Response:
+        url = self.base_url + endpoint
+        if isinstance(params, str):
+            # Pre-encoded (e.g. signed) query strings must reach the server byte for byte
+            if params:
+                url = f"{url}?{params}"
+            params = None
+        ctx = await self._bucket_for(endpoint)
+        await ctx.limit_request(weight)
+        response = await self._session.get(url, params=params, **kwargs)
+        if isinstance(self._rate_limit_context, BucketedRateLimiter):
+            ctx = self._rate_limit_context.rebucket(endpoint, response.headers, ctx)
+        await ctx.adjust_rate_limit(response.headers)
         return await self._handle(response)
 
     async def _post(self, endpoint: str, data: Any = None, **kwargs: Any) -> httpx.Response:
-        url = f"{self.base_url}{endpoint}"
+        url = self.base_url + endpoint
         response = await self._session.post(url, data=data, **kwargs)
         return await self._handle(response)
 
     async def _put(self, endpoint: str, data: Any = None, **kwargs: Any) -> httpx.Response:
-        url = f"{self.base_url}{endpoint}"
+        url = self.base_url + endpoint
         response = await self._session.put(url, data=data, **kwargs)
         return await self._handle(response)
 
     async def _delete(self, endpoint: str, **kwargs: Any) -> httpx.Response:
-        url = f"{self.base_url}{endpoint}"
+        url = self.base_url + endpoint
         response = await self._session.delete(url, **kwargs)
         return await self._handle(response)
     
     async def _handle(self, response: httpx.Response) -> httpx.Response:
-        try:
-            response.raise_for_status()
+        # Same range raise_for_status accepts, checked without entering a try block
+        if 200 <= response.status_code < 300:
             return response
 
-        except httpx.HTTPStatusError as e:
-            # Raised when response status code is 400 or higher
-            logger.error(f"HTTP httpx.Response Error: {e.response.status_code} {e.response.text}")
-
-        except httpx.RequestError as e:
-            # Raised in case of connection errors
-            logger.error(f"Connection error occurred while handling the request: {e}")
-
-        except Exception as e:
-            # Catch any other exceptions that may occur during response handling
-            logger.error(f"Unexpected error occurred while processing the response: {e}")
+        try:
+            response.raise_for_status()
+        except (httpx.HTTPStatusError, httpx.RequestError) as e:
+            logger.error(f"HTTP httpx.Response Error: {response.status_code} {response.text} ({e})")
 
         return response
     
@@ -158,11 +298,17 @@ class HTTPRequestor(Generic[T], IDataRequestor):
     def __init__(self, client: AsyncClient, endpoint: str, required_params: List[str]):
         self._client = client
         self._endpoint = endpoint if endpoint.startswith("/") else "/" + endpoint
+        self._namespace = sys.intern(client.base_url + self._endpoint)
         self.params = {}
-        self._required_params = required_params
+        self._required_set = frozenset(required_params)
+        self._call = self._request_func  # Bound once, skips the method lookup per request
+
+    @property
+    def namespace(self) -> str:
+        return self._namespace
 
     def has_required_params(self) -> bool:
-        missing_params = [p for p in self._required_params if p not in self.params]
+        missing_params = self._required_set.difference(self.params)
         if missing_params:
             logger.warning(f"Missing required params: {missing_params}")
             return False
@@ -175,7 +321,7 @@ class HTTPRequestor(Generic[T], IDataRequestor):
     async def request(self) -> Optional[T]:
         if not self.has_required_params():
             return None
-        return await self._request_func(self.params)
+        return await self._call(self.params)
 
 
 # @TODO: Change to DBRequestor and break out request method for composition
@@ -189,7 +335,8 @@ class Requestor(Generic[T], ABC):
         client: AsyncClient,
         endpoint: str,
         required_params: List[str],
-        default_return_value: Any,
+        default_return_value: Any = None,
+        default_factory: Optional[Callable[[], T]] = None,
         # request_weight: int
     ) -> None:
         self._dbm = dbm
@@ -197,28 +344,33 @@ class Requestor(Generic[T], ABC):
         if not endpoint.startswith("/"):
             endpoint = "/" + endpoint
         self._endpoint = endpoint
+        self._namespace = sys.intern(client.base_url + self._endpoint)
         self.params = {}
-        self.__required_params = required_params
-        self.__async_tasks: List[Coroutine] = []
+        self._required_set = frozenset(required_params)
+        self._call = self._request_func  # Bound once, skips the method lookup per request
+        self.__async_tasks: List[Callable[[], Coroutine]] = []
         self._save: bool = True
         self._delete_from_db: bool = False
-        self._default_return_value: T = default_return_value
+        self._default_factory: Callable[[], T] = default_factory or _default_factory_for(default_return_value)
         # self._request_weight: int = request_weight
         
     @property
     def namespace(self) -> str:
-        return self._client.base_url + self._endpoint
+        return self._namespace
     
+    def set_params(self: RequestorType, params: Dict) -> RequestorType:
+        self.params = params
+        return self
+
     @abstractmethod
     async def _request_func(self, params: Dict) -> Coroutine[Any, Any, Optional[Any]]:
         raise NotImplementedError("All subclasses must implement the _request_func method")
     
     def __has_required_params(self) -> bool:
-        for p in self.__required_params:
-            if p not in self.params:
-                logger.error(f"Missing required param: {p}")
-                
-        return all([p in self.params for p in self.__required_params])
+        if self._required_set.issubset(self.params):
+            return True
+        logger.error(f"Missing required params: {self._required_set.difference(self.params)}")
+        return False
 
     def save(self: RequestorType, save: bool) -> RequestorType:
         self._save = save
@@ -228,9 +380,23 @@ class Requestor(Generic[T], ABC):
         if not self.__has_required_params():
             return self
 
-        self.__async_tasks.append(self._dbm.delete_encoded(self.namespace, self.params))
+        # Queue a factory rather than a coroutine, nothing is created until request() runs it
+        self.__async_tasks.append(partial(self._dbm.delete_encoded, self.namespace, self.params))
         return self
     
+    async def __drain_tasks(self) -> None:
+        # Queued DB ops are independent, wait on them together and cancel the rest if one fails
+        pending, self.__async_tasks = self.__async_tasks, []
+        tasks = [asyncio.ensure_future(f()) for f in pending]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            # Collect the siblings so their errors aren't reported as never retrieved
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
     async def request_only(self) -> None:
         if await self._dbm.contains_encoded(self.namespace, self.params):
             return
@@ -243,16 +409,15 @@ class Requestor(Generic[T], ABC):
             raise RuntimeError("Required params not set")
 
         if self.__async_tasks:
-            for t in self.__async_tasks:
-                await t
+            await self.__drain_tasks()
 
         resp = await self._dbm.fetch_encoded(
             self.namespace,
-            self._request_func,
+            self._call,
             self.params,
             self._save,
         )
         if not resp:
-            return deepcopy(self._default_return_value)
+            return self._default_factory()
         else:
             return resp
@@ -1,9 +1,11 @@
 """
 This module provides a class for managing a database.
 """
+from collections import OrderedDict
 from hashlib import blake2b
 import json
 from pathlib import Path
+import pickle
 from typing import Any, Callable, Coroutine, Dict, Optional, Union
 from loguru import logger
 from pandas import DataFrame
@@ -12,12 +14,24 @@ from .sqlite import AsyncPickleSQLiteDB
 
 class DatabaseManager:   
     """This class provides methods for managing a database."""
-    def __init__(self, data_path: Path):
+    L1_SIZE = 1024  # Most recently used encoded entries kept in process, in front of SQLite
+    L1_MAX_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, data_path: Path, l1_max_bytes: Optional[int] = None):
+        """
+        :param l1_max_bytes: Byte budget for the in-process cache, 0 disables it.
+        """
         self._data_path = data_path
         self._db_name = "db"
         self._cache_name = "cache"
         self._DB = AsyncPickleSQLiteDB(self._data_path, self._db_name)
         self._DBCache = AsyncPickleSQLiteDB(self._data_path, self._cache_name)
+        # Pickled so every hit returns a fresh copy, like a load from SQLite
+        self._l1: OrderedDict[str, bytes] = OrderedDict()
+        self._l1_bytes = 0
+        self._l1_max_bytes = self.L1_MAX_BYTES if l1_max_bytes is None else l1_max_bytes
+        # Bumped at the start and end of every delete, reads that overlap one don't refill the L1
+        self._l1_epoch = 0
 
     def get_db(self, namespace: str) -> AsyncPickleSQLiteDB:
         """
@@ -26,6 +40,9 @@ class DatabaseManager:
         return self._DBCache if 'cache' in namespace else self._DB
 
     async def clear_cache(self):
+        self._l1.clear()
+        self._l1_bytes = 0
+        self._l1_epoch += 1
         await self._DBCache.close()
         cache_path = self._data_path / 'cache.sqlite'
         if cache_path.is_file():
@@ -43,14 +60,43 @@ class DatabaseManager:
         param_str = json.dumps(params, separators=(',', ':')) if isinstance(params, Dict) else params
         return self._hash(namespace + param_str)
 
+    def _l1_pop(self, key: str) -> None:
+        blob = self._l1.pop(key, None)
+        if blob is not None:
+            self._l1_bytes -= len(blob)
+
+    def _l1_put(self, key: str, data: Any, epoch: int) -> None:
+        if not self._l1_max_bytes or epoch != self._l1_epoch:
+            return
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        self._l1_pop(key)
+        if len(blob) > self._l1_max_bytes:
+            return
+        self._l1[key] = blob
+        self._l1_bytes += len(blob)
+        while len(self._l1) > self.L1_SIZE or self._l1_bytes > self._l1_max_bytes:
+            _, old = self._l1.popitem(last=False)
+            self._l1_bytes -= len(old)
+
     async def contains_encoded(self, namespace: str, params: Dict) -> bool:
-        return await self.get_db(namespace).contains_encoded(self.generate_db_key(namespace, params))
+        key = self.generate_db_key(namespace, params)
+        if key in self._l1:
+            return True
+        return await self.get_db(namespace).contains_encoded(key)
 
     async def load_encoded(self, namespace: str, params: Dict) -> Optional[Any]:
-        db = self.get_db(namespace)
         key = self.generate_db_key(namespace, params)
+        blob = self._l1.get(key)
+        if blob is not None:
+            self._l1.move_to_end(key)
+            return pickle.loads(blob)
+        epoch = self._l1_epoch
+        db = self.get_db(namespace)
         if await db.contains_encoded(key):
-            return await db.get_encoded(key)
+            data = await db.get_encoded(key)
+            if data is not None:
+                self._l1_put(key, data, epoch)
+            return data
         return None
 
     async def save_encoded(
@@ -59,7 +105,10 @@ class DatabaseManager:
             params: Dict,
             json_data: Any
         ) -> None:
-        await self.get_db(namespace).save_encoded(self.generate_db_key(namespace, params), json_data)
+        key = self.generate_db_key(namespace, params)
+        epoch = self._l1_epoch
+        await self.get_db(namespace).save_encoded(key, json_data)
+        self._l1_put(key, json_data, epoch)
         logger.info(f"{namespace} :: Saving data : {params}")
 
     async def save_dataframe(
@@ -91,7 +140,12 @@ class DatabaseManager:
             return None
 
     async def delete_encoded(self, namespace: str, params: Dict) -> None:
-        await self.get_db(namespace).delete_encoded(self.generate_db_key(namespace, params))
+        key = self.generate_db_key(namespace, params)
+        self._l1_epoch += 1
+        self._l1_pop(key)
+        await self.get_db(namespace).delete_encoded(key)
+        self._l1_epoch += 1
+        self._l1_pop(key)
         logger.info(f"{namespace} :: Deleting data : {params}")
 
     async def close_connections(self):